@@ -1,13 +1,39 @@
+import atexit
+import collections
 import datetime
 import functools
+import hashlib
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import random
+import sqlite3
+import threading
+import time
 import jwt
+try:
+	import queue
+except ImportError:
+	import Queue as queue
 from flask import Blueprint, current_app, request, abort, jsonify, _request_ctx_stack
 from werkzeug.local import LocalProxy
+try:
+	import click
+	from flask.cli import with_appcontext
+except ImportError:
+	# Flask < 0.11 doesn't have a CLI to hook into
+	click = None
 
 DEFAULT_CONFIG = {
 	'TOKENS_EXPIRY': datetime.timedelta(hours=10),
 	'TOKENS_LEEWAY': datetime.timedelta(seconds=0),
 	
+	'TOKENS_CREDENTIAL_CACHE_TTL': None,
+	'TOKENS_CREDENTIAL_CACHE_SIZE': 1024,
+	'TOKENS_CREDENTIAL_CACHE_ROUNDS': 1000,
+	
 	'TOKENS_ENABLE_BLUEPRINT': True,
 	'TOKENS_BLUEPRINT_NAME': 'tokens',
 	'TOKENS_URL_PREFIX': None,
@@ -16,7 +42,12 @@ DEFAULT_CONFIG = {
 	'TOKENS_AUTHORIZE_ENDPOINT': '/auth',
 	
 	'TOKENS_ENABLE_REFRESH': False,
-	'TOKENS_REFRESH_ENDPOINT': '/auth/refresh'
+	'TOKENS_REFRESH_ENDPOINT': '/auth/refresh',
+	
+	'TOKENS_ENABLE_CLI': True,
+	
+	'TOKENS_AUDIT_SAMPLE_RATE': 0.0,
+	'TOKENS_AUDIT_AUTH_FIELDS': []
 }
 
 
@@ -113,6 +144,348 @@ def _refresh_route():
 	return jsonify(res)
 
 
+# Offline bulk verification, for when you've got a pile of tokens (from access
+# logs, say) and want to know which of them are still good. Workers are forked
+# from the CLI process and inherit the application from _verify_app, so the
+# app doesn't have to be picklable; each of them pushes one app context per
+# chunk of tokens, rather than one per token. Where forking isn't possible,
+# everything runs in-process instead.
+_verify_app = None
+
+def _fork_context():
+	if not hasattr(multiprocessing, 'get_context'):
+		# Python 2 always forks, except on Windows, where it can't
+		return multiprocessing if os.name == 'posix' else None
+	try:
+		return multiprocessing.get_context('fork')
+	except ValueError:
+		return None
+
+def _verify_chunk(tokens):
+	with _verify_app.app_context():
+		ext = current_app.extensions['tokens']
+		return [_verify_result(ext, token) for token in tokens]
+
+def _verify_result(ext, token):
+	res = {'token': token}
+	
+	# One odd token (or a deserializer choking on it) shouldn't end a run over
+	# millions of them, so anything that goes wrong is reported for just that
+	# token instead
+	try:
+		status, payload = ext.check_token(token)
+		
+		# Report the claims even if the token didn't pass, as long as they can
+		# be read at all; which user an expired token belonged to is useful
+		if payload is None and status != 'malformed':
+			payload = jwt.decode(token, verify=False)
+	except Exception as e:
+		status, payload = 'error', None
+		res['error'] = '%s: %s' % (type(e).__name__, e)
+	
+	res['status'] = status
+	res['claims'] = payload
+	return res
+
+def _read_tokens(f):
+	prefix = 'Bearer '
+	for line in f:
+		token = line.strip()
+		if token.startswith(prefix):
+			token = token[len(prefix):]
+		if token:
+			yield token
+
+def _chunks(iterable, size):
+	it = iter(iterable)
+	while True:
+		chunk = list(itertools.islice(it, size))
+		if not chunk:
+			return
+		yield chunk
+
+if click:
+	@click.group('tokens')
+	def tokens_cli():
+		'''Token management commands.'''
+	
+	@tokens_cli.command('verify')
+	@click.argument('input', type=click.File('r'), default='-')
+	@click.option('-o', '--output', type=click.File('w'), default='-', help='Where to write results (default: stdout).')
+	@click.option('-j', '--workers', type=click.IntRange(min=1), default=None, help='Number of worker processes (default: one per CPU).')
+	@click.option('--chunk-size', type=click.IntRange(min=1), default=1000, help='Number of tokens handed to a worker at a time.')
+	@with_appcontext
+	def verify_command(input, output, workers, chunk_size):
+		'''Verify tokens read from INPUT, one per line (default: stdin).
+		
+		Writes one JSON object per token, in input order, with the token, its
+		status (valid, expired, bad_signature, malformed, invalid,
+		unknown_user, revoked or error) and its claims, if they could be read.
+		'''
+		global _verify_app
+		_verify_app = current_app._get_current_object()
+		
+		def write(results):
+			for res in results:
+				output.write(json.dumps(res, default=str) + '\n')
+		
+		chunks = _chunks(_read_tokens(input), chunk_size)
+		ctx = _fork_context()
+		if workers != 1 and not ctx:
+			click.echo("Can't fork worker processes on this platform, verifying in-process instead.", err=True)
+		if workers == 1 or not ctx:
+			for chunk in chunks:
+				write(_verify_chunk(chunk))
+			return
+		
+		# Only keep a couple of chunks per worker in flight, so that memory use
+		# stays bounded no matter how much input there is; results are written
+		# out in order as soon as the oldest pending chunk is done
+		pool = ctx.Pool(workers)
+		try:
+			window = (workers or multiprocessing.cpu_count()) * 2
+			pending = collections.deque()
+			for chunk in chunks:
+				pending.append(pool.apply_async(_verify_chunk, (chunk,)))
+				if len(pending) >= window:
+					write(pending.popleft().get())
+			while pending:
+				write(pending.popleft().get())
+		finally:
+			pool.terminate()
+			pool.join()
+
+
+
+# Audit events are handed off to a background thread, so that writing them to
+# a file or a database never adds latency to the request that triggered them.
+# Sinks are simple objects with a write(events) method, taking a list of event
+# dictionaries, and an optional close() method.
+class AuditLog(object):
+	def __init__(self, sinks, maxsize=10000, batch_size=100, flush_interval=1.0, overflow='drop', block_timeout=None):
+		'''Buffered, asynchronous audit event writer.
+		
+		Events are put in a bounded queue of `maxsize` events, and written out
+		to every sink in batches of up to `batch_size` events, at least every
+		`flush_interval` seconds.
+		
+		If the queue is full, `overflow` decides what happens: 'drop' discards
+		the event (and counts it in `dropped`), 'block' makes the request wait
+		for room (for up to `block_timeout` seconds, then drops it).
+		'''
+		if overflow not in ('drop', 'block'):
+			raise ValueError("overflow must be 'drop' or 'block', not %r" % overflow)
+		
+		self.sinks = list(sinks)
+		self.batch_size = batch_size
+		self.flush_interval = flush_interval
+		self.overflow = overflow
+		self.block_timeout = block_timeout
+		self.dropped = 0
+		
+		self._queue = queue.Queue(maxsize)
+		self._thread = None
+		self._lock = threading.Lock()
+		self._atexit_registered = False
+	
+	def emit(self, event):
+		# The writer thread is started lazily, so that an AuditLog created
+		# before a forking server spawns its workers works in each of them
+		if not self._thread or not self._thread.is_alive():
+			self.start()
+		
+		try:
+			if self.overflow == 'block':
+				self._queue.put(event, timeout=self.block_timeout)
+			else:
+				self._queue.put_nowait(event)
+		except queue.Full:
+			with self._lock:
+				self.dropped += 1
+	
+	def start(self):
+		with self._lock:
+			if self._thread and self._thread.is_alive():
+				return
+			self._thread = threading.Thread(target=self._run, name='flask-tokens-audit')
+			self._thread.daemon = True
+			self._thread.start()
+			
+			# The writer is a daemon thread, so it won't keep the process
+			# alive by itself; write out whatever is still queued on the way out
+			if not self._atexit_registered:
+				atexit.register(self.close)
+				self._atexit_registered = True
+	
+	def flush(self):
+		'''Block until every event emitted so far has been written.'''
+		if self._thread and self._thread.is_alive():
+			self._queue.join()
+	
+	def close(self):
+		'''Write out any pending events, stop the writer and close the sinks.'''
+		if self._thread and self._thread.is_alive():
+			self._queue.put(None)
+			self._thread.join()
+		else:
+			self._close_sinks()
+	
+	def _run(self):
+		running = True
+		while running:
+			# Wait for the first event of a batch, then grab whatever else is
+			# already waiting without blocking
+			try:
+				batch = [self._queue.get(timeout=self.flush_interval)]
+			except queue.Empty:
+				continue
+			while len(batch) < self.batch_size:
+				try:
+					batch.append(self._queue.get_nowait())
+				except queue.Empty:
+					break
+			
+			# A None is the signal to stop, sent by close()
+			events = [e for e in batch if e is not None]
+			running = len(events) == len(batch)
+			
+			if events:
+				self._write(events)
+			for _ in batch:
+				self._queue.task_done()
+		
+		# Sinks may hold on to things that belong to this thread, like SQLite
+		# connections, so they have to be closed from here as well
+		self._close_sinks()
+	
+	def _write(self, events):
+		# A broken sink shouldn't take the others (or the thread) down with it
+		for sink in self.sinks:
+			try:
+				sink.write(events)
+			except Exception:
+				logging.getLogger(__name__).exception("Couldn't write audit events to %r", sink)
+	
+	def _close_sinks(self):
+		for sink in self.sinks:
+			if hasattr(sink, 'close'):
+				sink.close()
+
+class JSONLinesAuditSink(object):
+	'''Appends audit events to a file, one JSON object per line.'''
+	
+	def __init__(self, path):
+		self.path = path
+		self._file = None
+	
+	def write(self, events):
+		if not self._file:
+			self._file = open(self.path, 'a')
+		for event in events:
+			self._file.write(json.dumps(event, default=str) + '\n')
+		self._file.flush()
+	
+	def close(self):
+		if self._file:
+			self._file.close()
+			self._file = None
+
+class SQLiteAuditSink(object):
+	'''Inserts audit events into an SQLite table, one transaction per batch.'''
+	
+	def __init__(self, path, table='audit_events'):
+		self.path = path
+		self.table = table
+		self._db = None
+	
+	def write(self, events):
+		# The connection has to be opened from the writer thread, as SQLite
+		# connections can't be shared between threads
+		if not self._db:
+			self._db = sqlite3.connect(self.path)
+			self._db.execute('CREATE TABLE IF NOT EXISTS %s (time REAL, event TEXT, user TEXT, data TEXT)' % self.table)
+		
+		rows = [(e.get('time'), e.get('event'), json.dumps(e.get('user'), default=str), json.dumps(e, default=str)) for e in events]
+		with self._db:
+			self._db.executemany('INSERT INTO %s VALUES (?, ?, ?, ?)' % self.table, rows)
+	
+	def close(self):
+		if self._db:
+			self._db.close()
+			self._db = None
+
+
+# Remembers successful credential checks for a short while, so that clients
+# hammering the auth endpoint with the same credentials don't pay for a full
+# password check every time. Submitted credentials are only ever kept as a
+# salted PBKDF2 digest; the salt is random and lives only in this process.
+# Entries map to the serializer's identifiers rather than the user object, so
+# the user is loaded fresh (with the deserializer) on every hit.
+class CredentialCache(object):
+	# Expiry is measured on a clock that can't be stepped backwards (by NTP,
+	# say), which would keep entries alive for longer than the TTL; Python 2
+	# doesn't have one, so it has to make do with the wall clock
+	_clock = staticmethod(getattr(time, 'monotonic', time.time))
+	
+	def __init__(self, ttl, maxsize=1024, rounds=1000):
+		self.ttl = ttl
+		self.maxsize = maxsize
+		self.rounds = rounds
+		
+		self._salt = os.urandom(16)
+		self._entries = collections.OrderedDict()
+		self._by_identity = {}
+		self._lock = threading.Lock()
+	
+	def key(self, auth):
+		data = json.dumps(auth, sort_keys=True, default=str).encode('utf-8')
+		return hashlib.pbkdf2_hmac('sha256', data, self._salt, self.rounds)
+	
+	def get(self, key):
+		with self._lock:
+			entry = self._entries.get(key)
+			if not entry:
+				return None
+			expires, identity = entry
+			if expires < self._clock():
+				self._remove(key)
+				return None
+			return identity
+	
+	def set(self, key, identity):
+		with self._lock:
+			self._remove(key)
+			self._entries[key] = (self._clock() + self.ttl, identity)
+			self._by_identity.setdefault(self._identity_key(identity), set()).add(key)
+			
+			# Evict the oldest entries once full; they're the closest to
+			# expiring anyways
+			while len(self._entries) > self.maxsize:
+				self._remove(next(iter(self._entries)))
+	
+	def forget(self, identity):
+		with self._lock:
+			for key in list(self._by_identity.get(self._identity_key(identity), ())):
+				self._remove(key)
+	
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+			self._by_identity.clear()
+	
+	def _remove(self, key):
+		entry = self._entries.pop(key, None)
+		if entry:
+			identity_key = self._identity_key(entry[1])
+			keys = self._by_identity.get(identity_key)
+			keys.discard(key)
+			if not keys:
+				del self._by_identity[identity_key]
+	
+	def _identity_key(self, identity):
+		return json.dumps(identity, sort_keys=True, default=str)
+
+
 
 # Just stick this thing onto your Flask object, and decorate some handlers.
 class Tokens(object):
@@ -125,11 +498,13 @@ class Tokens(object):
 	_refresh_issuer = None
 	_auth_response_handler = None
 	_refresh_response_handler = None
+	_credential_cache = None
 	
 	
 	
-	def __init__(self, app=None):
+	def __init__(self, app=None, audit_log=None):
 		self.app = app
+		self.audit_log = audit_log
 		if self.app:
 			self.init_app(self.app)
 	
@@ -154,12 +529,23 @@ class Tokens(object):
 				bp.add_url_rule(app.config.get('TOKENS_REFRESH_ENDPOINT'), 'refresh', _refresh_route, methods=['POST'])
 			
 			app.register_blueprint(bp, url_prefix=app.config.get('TOKENS_URL_PREFIX'))
+		
+		# Set up the credential cache, if it's been asked for
+		ttl = app.config.get('TOKENS_CREDENTIAL_CACHE_TTL')
+		if ttl:
+			self._credential_cache = CredentialCache(ttl.total_seconds(),
+				maxsize=app.config.get('TOKENS_CREDENTIAL_CACHE_SIZE'),
+				rounds=app.config.get('TOKENS_CREDENTIAL_CACHE_ROUNDS'))
+		
+		# Mount the 'flask tokens' commands
+		if click and hasattr(app, 'cli') and app.config.get('TOKENS_ENABLE_CLI'):
+			app.cli.add_command(tokens_cli)
 	
 	
 	
 	def make_token(self, auth):
 		# Try to authorize the user first of all
-		user = self._user_loader(auth)
+		user = self._load_user(auth)
 		
 		# Sign the user in for the remainder of the request, or just put a None
 		# there to mark that an attempt to log in was made, and that there's no
@@ -168,15 +554,24 @@ class Tokens(object):
 		
 		# Don't do anything if the login was wrong
 		if not user:
+			# Record who the login was attempted as, if asked to; only the
+			# fields listed in the config are copied, so the password (or
+			# anything else secret) never makes it in there
+			fields = current_app.config.get('TOKENS_AUDIT_AUTH_FIELDS')
+			attempted = dict((key, auth[key]) for key in fields if key in auth)
+			self._audit('login_failed', auth=attempted or None)
 			return None
 		
+		self._audit('login', user)
+		
 		# Return a ready-made token
 		return self._encode(self._make_payload(user))
 	
 	def verify_token(self, token):
 		# Try to decode the token; abort if it's invalid or expired
-		payload = self._decode(token)
+		status, payload = self._decode_status(token)
 		if not payload:
+			self._audit('verify_failed', reason=status)
 			return None
 		
 		# Deserialize a proper user object from the payload
@@ -187,17 +582,26 @@ class Tokens(object):
 		# a function that looks the token up in a db, checks an "issued at"
 		# timestamp against a "all tokens revoked at" one, etc.
 		if not self._verifier or self._verifier(user, payload):
+			# Successful verifications happen on every request, so only a
+			# sample of them is audited (none by default)
+			rate = current_app.config.get('TOKENS_AUDIT_SAMPLE_RATE')
+			if rate and random.random() < rate:
+				self._audit('verify', user)
+			
 			_request_ctx_stack.top.current_user = user
 			return payload
 		else:
+			self._audit('verify_failed', user, reason='rejected')
+			
 			# Nullify the current user, to prevent attempts to repeatedly
 			# revalidate the user when current_user is accessed
 			_request_ctx_stack.top.current_user = None
 	
 	def refresh_token(self, token, refresh_token):
 		# Decode the token, completely ignoring the expiration
-		payload = self._decode(token, verify_expiration=False)
+		status, payload = self._decode_status(token, verify_expiration=False)
 		if not payload:
+			self._audit('refresh_failed', reason=status)
 			return None
 		
 		# Deserialize the user from the payload
@@ -207,6 +611,8 @@ class Tokens(object):
 		# refresh was denied for whatever reason. This is very app-specific.
 		new_payload = self._refresh_handler(user, payload, refresh_token)
 		if new_payload:
+			self._audit('refresh', user)
+			
 			# Sign the user in for the remainder of the request
 			_request_ctx_stack.top.current_user = user
 			
@@ -215,6 +621,8 @@ class Tokens(object):
 			new_payload = self._make_payload(user, new_payload)
 			return self._encode(payload)
 		else:
+			self._audit('refresh_failed', user, reason='rejected')
+			
 			# Nullify the current user, to prevent attempts to repeatedly
 			# revalidate the user when current_user is accessed
 			_request_ctx_stack.top.current_user = None
@@ -222,6 +630,52 @@ class Tokens(object):
 	def issue_refresh_token(self, user):
 		return self._refresh_issuer(user)
 	
+	def forget_credentials(self, user):
+		'''Drop any cached credential checks for a user.
+		
+		Call this whenever a user's password (or whatever else the user loader
+		checks) changes, so the old credentials stop working in this process
+		rather than when the cache entry expires. Does nothing if the
+		credential cache is disabled.
+		
+		The cache is per-process, so this can't reach other processes: under
+		gunicorn, uwsgi, etc. with several workers, the others will keep
+		accepting the old credentials until their entries expire. Keep
+		TOKENS_CREDENTIAL_CACHE_TTL short (seconds, not minutes) for that
+		reason.
+		
+		```
+		def set_password(user, password):
+			user.password_hash = hash_password(password)
+			tokens.forget_credentials(user)
+		```
+		'''
+		if self._credential_cache:
+			self._credential_cache.forget(self._serializer(user))
+	
+	def check_token(self, token):
+		'''Check a token without signing anyone in.
+		
+		Returns a (status, payload) tuple, where status is one of 'valid',
+		'expired', 'bad_signature', 'malformed', 'invalid' (any other claim
+		check failed, eg. 'nbf' is in the future), 'unknown_user' or
+		'revoked', and payload is the decoded payload if the token is valid,
+		else None.
+		
+		Only needs an application context, not a request context.
+		'''
+		status, payload = self._decode_status(token)
+		if status != 'valid':
+			return status, None
+		
+		user = self._deserializer(payload)
+		if not user:
+			return 'unknown_user', None
+		if self._verifier and not self._verifier(user, payload):
+			return 'revoked', None
+		
+		return status, payload
+	
 	
 	
 	def _make_payload(self, user, payload={}):
@@ -242,21 +696,69 @@ class Tokens(object):
 		
 		return payload
 	
+	def _load_user(self, auth):
+		cache = self._credential_cache
+		if not cache:
+			return self._user_loader(auth)
+		
+		# Look for a recent successful check with the same credentials; the
+		# user could have been deleted since, so fall back to the user loader
+		# if the deserializer can't find them anymore
+		key = cache.key(auth)
+		identity = cache.get(key)
+		if identity is not None:
+			user = self._deserializer(identity)
+			if user:
+				return user
+		
+		# Only ever remember successful checks
+		user = self._user_loader(auth)
+		if user:
+			cache.set(key, self._serializer(user))
+		return user
+	
+	def _audit(self, event, user=None, **data):
+		if not self.audit_log:
+			return
+		
+		# Identify the user the same way tokens do, never with anything the
+		# client submitted (which may well contain a password)
+		data['event'] = event
+		data['time'] = time.time()
+		data['user'] = self._serializer(user) if user else None
+		if request:
+			data['remote_addr'] = request.remote_addr
+		
+		self.audit_log.emit(data)
+	
 	def _encode(self, payload):
 		secret = current_app.config.get('SECRET_KEY')
 		return jwt.encode(payload, secret)
 	
-	def _decode(self, token, verify_expiration=True):
+	def _decode_status(self, token, verify_expiration=True):
 		try:
 			# Try to decode the token - this blows up spectacularly if it fails
 			leeway = current_app.config.get('TOKENS_LEEWAY')
-			return jwt.decode(token, current_app.config.get('SECRET_KEY'), leeway=leeway.total_seconds())
-		except jwt.DecodeError:
-			# The token was tampered with, corrupted or otherwise invalid
-			return None
+			return 'valid', jwt.decode(token, current_app.config.get('SECRET_KEY'), leeway=leeway.total_seconds())
+		except jwt.InvalidSignatureError:
+			# The token was tampered with, or signed with some other key
+			return 'bad_signature', None
 		except jwt.ExpiredSignature:
 			# The token has already expired, and the leeway couldn't save it :(
-			return None
+			return 'expired', None
+		except jwt.DecodeError:
+			# The token is corrupted; if it can still be decoded without being
+			# checked, it's one of the claims that's broken (eg. a non-numeric
+			# 'exp'), otherwise it's just garbage
+			try:
+				jwt.decode(token, verify=False)
+			except jwt.DecodeError:
+				return 'malformed', None
+			return 'invalid', None
+		except jwt.InvalidTokenError:
+			# Some other claim didn't check out; not yet valid, wrong audience,
+			# disallowed algorithm, etc.
+			return 'invalid', None
 	
 	
 	
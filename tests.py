@@ -5,20 +5,54 @@ from flask import Flask, jsonify
 from flask.ext.tokens import *
 from flask.ext.testing import TestCase
 import jwt
+import json
+import flask_tokens
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from click.testing import CliRunner
+from flask.cli import ScriptInfo
 
 SECRET_KEY = 'Lorem ipsum'
 
+class MemoryAuditSink(object):
+	def __init__(self):
+		self.events = []
+	
+	def write(self, events):
+		self.events.extend(events)
+
+class BlockingAuditSink(MemoryAuditSink):
+	def __init__(self):
+		super(BlockingAuditSink, self).__init__()
+		self.started = threading.Event()
+		self.release = threading.Event()
+	
+	def write(self, events):
+		self.started.set()
+		self.release.wait()
+		super(BlockingAuditSink, self).write(events)
+
 class TestTokens(TestCase):
+	config = {}
+	
 	def create_app(self):
 		app = Flask(__name__)
 		app.config['TESTING'] = True
 		app.config['SECRET_KEY'] = SECRET_KEY
 		app.config['TOKENS_ENABLE_REFRESH'] = True
+		app.config.update(self.config)
 		
-		tokens = Tokens(app)
+		self.audit_sink = MemoryAuditSink()
+		self.audit_log = AuditLog([self.audit_sink], flush_interval=0.1)
+		tokens = Tokens(app, audit_log=self.audit_log)
 		
 		@tokens.user_loader
 		def user_loader(auth):
+			self.user_loader_calls += 1
 			for user in self.users.values():
 				if auth['username'] == user['username'] and\
 					auth['password'] == user['password']:
@@ -30,7 +64,7 @@ class TestTokens(TestCase):
 		
 		@tokens.deserializer
 		def deserializer(payload):
-			return self.users[payload['user_id']]
+			return self.users.get(payload['user_id'])
 		
 		@tokens.payload_handler
 		def payload_handler(user, payload):
@@ -75,6 +109,7 @@ class TestTokens(TestCase):
 		return app
 	
 	def setUp(self):
+		self.user_loader_calls = 0
 		self.users = {
 			1: {
 				'id': 1,
@@ -85,6 +120,9 @@ class TestTokens(TestCase):
 			}
 		}
 	
+	def tearDown(self):
+		self.audit_log.close()
+	
 	def auth_headers(self, token, headers={}):
 		headers['Authorization'] = 'Bearer ' + token
 		return headers
@@ -142,6 +180,250 @@ class TestTokens(TestCase):
 		res = self.client.get('/protected', headers=self.auth_headers(auth['token']))
 		self.assert_200(res)
 		assert res.json['user_id'] == 1
+	
+	def audit_events(self):
+		self.audit_log.flush()
+		return [e['event'] for e in self.audit_sink.events]
+	
+	def test_audit_login(self):
+		self.login()
+		assert self.audit_events() == ['login']
+		assert self.audit_sink.events[0]['user'] == {'user_id': 1}
+	
+	def test_audit_login_failed(self):
+		self.client.post('/auth', data={'username': 'username', 'password': 'wrongpass'})
+		assert self.audit_events() == ['login_failed']
+		assert 'wrongpass' not in repr(self.audit_sink.events)
+		assert self.audit_sink.events[0]['auth'] is None
+	
+	def test_audit_login_failed_fields(self):
+		self.app.config['TOKENS_AUDIT_AUTH_FIELDS'] = ['username']
+		self.client.post('/auth', data={'username': 'username', 'password': 'wrongpass'})
+		assert self.audit_events() == ['login_failed']
+		assert self.audit_sink.events[0]['auth'] == {'username': 'username'}
+		assert 'wrongpass' not in repr(self.audit_sink.events)
+	
+	def test_audit_verify(self):
+		auth = self.login()
+		self.client.get('/protected', headers=self.auth_headers(auth['token']))
+		self.client.get('/protected', headers=self.auth_headers('garbage'))
+		assert self.audit_events() == ['login', 'verify_failed']
+		assert self.audit_sink.events[1]['reason'] == 'malformed'
+	
+	def test_audit_verify_sampled(self):
+		self.app.config['TOKENS_AUDIT_SAMPLE_RATE'] = 1.0
+		auth = self.login()
+		self.client.get('/protected', headers=self.auth_headers(auth['token']))
+		assert self.audit_events() == ['login', 'verify']
+		assert self.audit_sink.events[1]['user'] == {'user_id': 1}
+	
+	def test_audit_verify_expired(self):
+		expired = jwt.encode({'user_id': 1, 'iat': 1, 'exp': 1}, SECRET_KEY)
+		self.client.get('/protected', headers=self.auth_headers(expired))
+		assert self.audit_events() == ['verify_failed']
+		assert self.audit_sink.events[0]['reason'] == 'expired'
+	
+	def test_audit_refresh(self):
+		auth = self.login()
+		self.client.post('/auth/refresh', data={'token': auth['token'], 'refresh_token': 'wrong'})
+		self.client.post('/auth/refresh', data={'token': auth['token'], 'refresh_token': auth['refresh_token']})
+		assert self.audit_events() == ['login', 'refresh_failed', 'refresh']
+	
+	def check_token(self, token):
+		return current_app.extensions['tokens'].check_token(token)
+	
+	def test_check_token(self):
+		auth = self.login()
+		expired = jwt.encode({'user_id': 1, 'iat': 1, 'exp': 1}, SECRET_KEY)
+		forged = jwt.encode({'user_id': 1}, 'Not the secret')
+		
+		assert self.check_token(auth['token'])[0] == 'valid'
+		assert self.check_token(expired) == ('expired', None)
+		assert self.check_token(forged) == ('bad_signature', None)
+		assert self.check_token('garbage') == ('malformed', None)
+		
+		immature = jwt.encode({'user_id': 1, 'nbf': 2 ** 40}, SECRET_KEY)
+		assert self.check_token(immature) == ('invalid', None)
+		
+		bad_exp = jwt.encode({'user_id': 1, 'exp': 'abc'}, SECRET_KEY)
+		assert self.check_token(bad_exp) == ('invalid', None)
+		
+		unknown = jwt.encode({'user_id': 2}, SECRET_KEY)
+		assert self.check_token(unknown) == ('unknown_user', None)
+		
+		self.users[1]['last_revocation'] = datetime.datetime.utcnow() + datetime.timedelta(seconds=1)
+		assert self.check_token(auth['token']) == ('revoked', None)
+	
+	def verify_cli(self, tokens, *args):
+		obj = ScriptInfo(create_app=lambda *args: self.app)
+		res = CliRunner().invoke(tokens_cli, ['verify'] + list(args), input=tokens, obj=obj)
+		assert res.exit_code == 0, res.output
+		return [json.loads(line) for line in res.output.splitlines()]
+	
+	def test_cli_verify(self):
+		auth = self.login()
+		forged = jwt.encode({'user_id': 1}, 'Not the secret')
+		unknown = jwt.encode({'user_id': 2}, SECRET_KEY)
+		tokens = '\n'.join([auth['token'], 'Bearer ' + forged, '', 'garbage', unknown]) + '\n'
+		
+		results = self.verify_cli(tokens, '--workers', '1')
+		assert [r['status'] for r in results] == ['valid', 'bad_signature', 'malformed', 'unknown_user']
+		assert results[1]['token'] == forged
+		assert results[1]['claims'] == {'user_id': 1}
+		assert results[2]['claims'] is None
+		assert results[3]['claims'] == {'user_id': 2}
+	
+	def test_cli_verify_error(self):
+		def deserializer(payload):
+			raise RuntimeError('Database is down')
+		current_app.extensions['tokens'].deserializer(deserializer)
+		
+		token = jwt.encode({'user_id': 1}, SECRET_KEY)
+		results = self.verify_cli(token + '\n' + token + '\n', '--workers', '1')
+		assert [r['status'] for r in results] == ['error', 'error']
+		assert results[0]['error'] == 'RuntimeError: Database is down'
+	
+	def test_cli_verify_no_fork(self):
+		fork_context = flask_tokens._fork_context
+		flask_tokens._fork_context = lambda: None
+		try:
+			obj = ScriptInfo(create_app=lambda *args: self.app)
+			res = CliRunner().invoke(tokens_cli, ['verify', '--workers', '2'], input='garbage\n', obj=obj)
+		finally:
+			flask_tokens._fork_context = fork_context
+		
+		assert res.exit_code == 0, res.output
+		assert "Can't fork worker processes" in res.output
+		assert '"malformed"' in res.output
+	
+	def test_cli_verify_pool(self):
+		# Enough tokens for several windows' worth of chunks, some of them
+		# broken, to make sure results come back in input order
+		auth = self.login()
+		tokens = [auth['token'] if i % 3 else 'garbage-%d' % i for i in range(50)]
+		
+		results = self.verify_cli('\n'.join(tokens) + '\n', '--workers', '2', '--chunk-size', '3')
+		assert [r['token'] for r in results] == tokens
+		assert [r['status'] for r in results] == ['valid' if i % 3 else 'malformed' for i in range(50)]
+	
+	def test_cli_verify_bad_options(self):
+		obj = ScriptInfo(create_app=lambda *args: self.app)
+		for args in (['--workers', '0'], ['--chunk-size', '0']):
+			res = CliRunner().invoke(tokens_cli, ['verify'] + args, input='', obj=obj)
+			assert res.exit_code == 2, res.output
+
+class TestAuditLog(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+	
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+	
+	def events(self, n):
+		return [{'event': 'login', 'time': float(i), 'user': {'user_id': i}} for i in range(n)]
+	
+	def test_json_lines_sink(self):
+		path = os.path.join(self.tmpdir, 'audit.jsonl')
+		log = AuditLog([JSONLinesAuditSink(path)], batch_size=2)
+		for event in self.events(5):
+			log.emit(event)
+		log.close()
+		
+		with open(path) as f:
+			assert [json.loads(line) for line in f] == self.events(5)
+	
+	def test_sqlite_sink(self):
+		path = os.path.join(self.tmpdir, 'audit.db')
+		log = AuditLog([SQLiteAuditSink(path)], batch_size=2)
+		for event in self.events(5):
+			log.emit(event)
+		log.close()
+		
+		db = sqlite3.connect(path)
+		rows = db.execute('SELECT time, event, user, data FROM audit_events ORDER BY time').fetchall()
+		db.close()
+		assert [(r[0], r[1], json.loads(r[2])) for r in rows] == [(e['time'], e['event'], e['user']) for e in self.events(5)]
+		assert [json.loads(r[3]) for r in rows] == self.events(5)
+	
+	def fill(self, log, sink):
+		# The first event is picked up by the writer, which then gets stuck in
+		# the sink; the second fills the queue, and the third doesn't fit
+		events = self.events(3)
+		log.emit(events[0])
+		assert sink.started.wait(1)
+		log.emit(events[1])
+		log.emit(events[2])
+	
+	def test_overflow_drop(self):
+		sink = BlockingAuditSink()
+		log = AuditLog([sink], maxsize=1, batch_size=1, overflow='drop')
+		self.fill(log, sink)
+		assert log.dropped == 1
+		
+		sink.release.set()
+		log.close()
+		assert sink.events == self.events(2)
+	
+	def test_overflow_block(self):
+		sink = BlockingAuditSink()
+		log = AuditLog([sink], maxsize=1, batch_size=1, overflow='block', block_timeout=0.1)
+		start = time.time()
+		self.fill(log, sink)
+		assert time.time() - start >= 0.1
+		assert log.dropped == 1
+		
+		sink.release.set()
+		log.close()
+		assert sink.events == self.events(2)
+	
+	def test_overflow_block_waits(self):
+		sink = BlockingAuditSink()
+		log = AuditLog([sink], maxsize=1, batch_size=1, overflow='block', block_timeout=5)
+		threading.Timer(0.1, sink.release.set).start()
+		self.fill(log, sink)
+		assert log.dropped == 0
+		
+		log.close()
+		assert sink.events == self.events(3)
+
+class TestCredentialCache(TestTokens):
+	config = {'TOKENS_CREDENTIAL_CACHE_TTL': datetime.timedelta(seconds=30)}
+	
+	def test_credential_cache(self):
+		self.login()
+		self.login()
+		assert self.user_loader_calls == 1
+	
+	def test_credential_cache_failed(self):
+		for _ in range(2):
+			self.assert_403(self.client.post('/auth', data={'username': 'username', 'password': 'wrongpass'}))
+		assert self.user_loader_calls == 2
+	
+	def test_credential_cache_forget(self):
+		self.login()
+		current_app.extensions['tokens'].forget_credentials(self.users[1])
+		self.login()
+		assert self.user_loader_calls == 2
+	
+	def test_credential_cache_expiry(self):
+		current_app.extensions['tokens']._credential_cache.ttl = 0.1
+		self.login()
+		self.login()
+		assert self.user_loader_calls == 1
+		
+		time.sleep(0.15)
+		self.login()
+		assert self.user_loader_calls == 2
+	
+	def test_credential_cache_size(self):
+		current_app.extensions['tokens']._credential_cache.maxsize = 1
+		self.users[2] = dict(self.users[1], id=2, username='other')
+		
+		# Logging in as someone else pushes the first user's entry out
+		self.login()
+		self.assert_200(self.client.post('/auth', data={'username': 'other', 'password': 'password'}))
+		self.login()
+		assert self.user_loader_calls == 3
 
 if __name__ == '__main__':
 	unittest.main()